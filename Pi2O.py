@@ -3,23 +3,23 @@
 import os
 import sys
 import time
-import getopt
 import calendar
-import threading
-from datetime import datetime, timedelta
+from datetime import datetime
 
 import jinja2
 import cherrypy
 from cherrypy.process.plugins import Daemonizer
-
-import logging
 try:
-    from logging.handlers import WatchedFileHandler
+    import ujson as json
 except ImportError:
-    from logging import FileHandler as WatchedFileHandler
+    import json
+
+import logging
+from logging.handlers import RotatingFileHandler
     
 from config import *
 from database import Archive
+from expiring_cache import expiring_cache
 from scheduler import ScheduleProcessor
 from weather import getCurrentTemperature, getWeatherAdjustment
 
@@ -31,9 +31,42 @@ JS_PATH = os.path.join(_BASE_PATH, 'js')
 TEMPLATE_PATH = os.path.join(_BASE_PATH, 'templates')
 
 
+# Number of entries to show in the logs
+MAX_LOG_ENTRIES = 25
+
+
+
+# Zone status and manual selection strings indexed by isActive()
+_STATUS = ('off', 'on')
+_SELECTED = ('', 'selected')
+
+
+# Run time suffixes for the logs
+_SUFFIX_RUNNING = ' <i>(running)</i>'
+_SUFFIX_IDLE = ''
+
+
+# Month names for the schedules page
+MONTH_NAMES = ('January', 'February', 'March', 'April', 'May', 'June', 
+               'July', 'August', 'September', 'October', 'November', 'December')
+
+
 # Jinja configuration
+## The compiled templates are also cached on disk so that restarts do not
+## need to parse them again
 jinjaEnv = jinja2.Environment(loader=jinja2.FileSystemLoader(TEMPLATE_PATH), 
-                              extensions=['jinja2.ext.loopcontrols',])
+                              extensions=['jinja2.ext.loopcontrols',], 
+                              auto_reload=False, 
+                              bytecode_cache=jinja2.FileSystemBytecodeCache())
+jinjaEnv.globals['mname'] = MONTH_NAMES
+
+## Templates - loaded once so that requests don't need to go through the loader
+INDEX_TMPL = jinjaEnv.get_template('index.html')
+ZONES_TMPL = jinjaEnv.get_template('zones.html')
+SCHEDULES_TMPL = jinjaEnv.get_template('schedules.html')
+WEATHER_TMPL = jinjaEnv.get_template('weather.html')
+MANUAL_TMPL = jinjaEnv.get_template('manual.html')
+LOG_TMPL = jinjaEnv.get_template('log.html')
 
 
 """
@@ -63,9 +96,8 @@ def daemonize(stdin='/dev/null', stdout='/dev/null', stderr='/dev/null'):
     will be opened and be used to replace the standard file descriptors
     in sys.stdin, sys.stdout, and sys.stderr.
     These arguments are optional and default to /dev/null.
-    Note that stderr is opened unbuffered, so
-    if it shares a file with stdout then interleaved output
-    may not appear in the order that you expect.
+    The files are opened at the file descriptor level and
+    stdout/stderr are opened for appending.
     """
     
     # Do first fork.
@@ -94,12 +126,82 @@ def daemonize(stdin='/dev/null', stdout='/dev/null', stderr='/dev/null'):
     # Now I am a daemon!
     
     # Redirect standard file descriptors.
-    si = file(stdin, 'r')
-    so = file(stdout, 'a+')
-    se = file(stderr, 'a+', 0)
-    os.dup2(si.fileno(), sys.stdin.fileno())
-    os.dup2(so.fileno(), sys.stdout.fileno())
-    os.dup2(se.fileno(), sys.stderr.fileno())
+    si = os.open(stdin, os.O_RDONLY)
+    so = os.open(stdout, os.O_WRONLY|os.O_APPEND|os.O_CREAT, 0644)
+    se = os.open(stderr, os.O_WRONLY|os.O_APPEND|os.O_CREAT, 0644)
+    os.dup2(si, sys.stdin.fileno())
+    os.dup2(so, sys.stdout.fileno())
+    os.dup2(se, sys.stderr.fileno())
+    for fd in (si, so, se):
+        os.close(fd)
+
+
+@expiring_cache(maxage=3600)
+def _tzOffset():
+    """
+    Return the offset between local time and UTC in seconds.  The value is 
+    cached for an hour so that DST changes are picked up.
+    """
+    
+    if time.daylight and time.localtime().tm_isdst > 0:
+        return -time.altzone
+    else:
+        return -time.timezone
+
+
+@expiring_cache(maxage=3600, maxsize=256)
+def _fmtTime(timestamp):
+    """
+    Convert a UNIX timestamp into a local time string of the form 
+    YYYY-MM-DD HH:MM:SS.  The log pages show the same few dozen start times
+    on every poll so the strings are cached for an hour.
+    """
+    
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(timestamp))
+
+
+@expiring_cache(maxage=3600, maxsize=1024)
+def _serializeTimestamp(timestamp):
+    """
+    Convert a UNIX timestamp from the archive into the JavaScript-style local
+    time in milliseconds that AJAX.serialize() returns for the equivalent 
+    datetime.  The conversion of a given timestamp only changes if the time 
+    zone of the system does so the values are cached for an hour.
+    """
+    
+    dt = datetime.fromtimestamp(timestamp)
+    return int(calendar.timegm(dt.timetuple()) * 1000 + dt.microsecond / 1000)
+
+
+def _formatLogEntry(entry, tNow=None):
+    """
+    Given an entry from the archive, return a three-element tuple of strings
+    for the start time, run time, and weather adjustment.  The optional 
+    'tNow' UNIX timestamp is used for the run time of entries that are still
+    running so that callers formatting several entries only need to look up
+    the time once.
+    """
+    
+    start = _fmtTime(entry.dateTimeStart)
+    if entry.dateTimeStop >= entry.dateTimeStart:
+        runtime = entry.dateTimeStop - entry.dateTimeStart
+        suffix = _SUFFIX_IDLE
+    else:
+        if tNow is None:
+            tNow = time.time()
+        runtime = tNow - entry.dateTimeStart
+        suffix = _SUFFIX_RUNNING
+    h, rem = divmod(int(runtime), 3600)
+    m, s = divmod(rem, 60)
+    run = "%i:%02i:%02i%s" % (h, m, s, suffix)
+    if entry.wxAdjust >= 0:
+        adjust = "%d%%" % int(entry.wxAdjust*100)
+    elif entry.wxAdjust == -1:
+        adjust = 'Manual'
+    else:
+        adjust = 'Disabled'
+        
+    return start, run, adjust
 
 
 def usage(exitCode=None):
@@ -127,33 +229,73 @@ def parseOptions(args):
     config['debug'] = False
     config['logfile'] = '/var/log/pi2o'
 
-    try:
-        opts, args = getopt.getopt(args, "hp:dl:", ["help", "pid-file=", "debug", "logfile="])
-    except getopt.GetoptError, err:
-        # Print help information and exit:
-        print str(err) # will print something like "option -a not recognized"
-        usage(exitCode=2)
-    
-    # Work through opts
-    for opt, value in opts:
-        if opt in ('-h', '--help'):
+    # Work through the command line
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        if arg in ('-h', '--help'):
             usage(exitCode=0)
-        elif opt in ('-p', '--pid-file'):
-            config['pidFile'] = str(value)
-        elif opt in ('-d', '--debug'):
+        elif arg in ('-d', '--debug'):
             config['debug'] = True
-        elif opt in ('-l', '--logfile'):
-            config['logfile'] = value
+        elif arg in ('-p', '--pid-file', '-l', '--logfile'):
+            ## Options that take the next argument as their value
+            i += 1
+            if i == len(args):
+                print "option %s requires argument" % arg
+                usage(exitCode=2)
+            if arg in ('-p', '--pid-file'):
+                config['pidFile'] = str(args[i])
+            else:
+                config['logfile'] = args[i]
+        elif arg.startswith('--pid-file='):
+            config['pidFile'] = str(arg.split('=', 1)[1])
+        elif arg.startswith('--logfile='):
+            config['logfile'] = arg.split('=', 1)[1]
+        elif arg[:2] == '-p':
+            config['pidFile'] = str(arg[2:])
+        elif arg[:2] == '-l':
+            config['logfile'] = arg[2:]
+        elif arg == '--':
+            i += 1
+            break
+        elif arg[:1] == '-' and arg != '-':
+            # Print help information and exit:
+            print "option %s not recognized" % arg
+            usage(exitCode=2)
         else:
-            assert False
-    
+            break
+        i += 1
+        
     # Add in arguments
-    config['args'] = args
+    config['args'] = args[i:]
 
     # Return configuration
     return config
 
 
+def _jsonHandler(*args, **kwds):
+    """
+    Output handler for cherrypy.tools.json_out that serializes the return 
+    value of the page handler with ujson, if available.
+    """
+    
+    value = cherrypy.serving.request._json_inner_handler(*args, **kwds)
+    return json.dumps(value)
+
+
+def _streamTemplate(template, kwds):
+    """
+    Render a template for a page handler in chunks that CherryPy sends out
+    as they are generated rather than building the whole page first.
+    """
+    
+    cherrypy.serving.response.stream = True
+    
+    stream = template.stream({'kwds':kwds})
+    stream.enable_buffering(size=32)
+    return stream
+
+
 # AJAX interface
 class AJAX(object):
     def __init__(self, config, hardwareZones, history):
@@ -161,54 +303,94 @@ class AJAX(object):
         self.hardwareZones = hardwareZones
         self.history = history
         
+        # Pre-built output keys for each zone and log entry
+        self._keys = []
+        for i in xrange(1, len(self.hardwareZones)+1):
+            self._keys.append({'status': 'status%i' % i, 'name': 'name%i' % i, 
+                               'start': 'start%i' % i, 'run': 'run%i' % i, 'adjust': 'adjust%i' % i})
+            
+        # Form field names that control a zone mapped to the zone number, 
+        # i.e., 'zone1' -> 1
+        self._zoneKws = dict(('zone%i' % i, i) for i in xrange(1, len(self.hardwareZones)+1))
+        self._logKeys = []
+        for i in xrange(1, MAX_LOG_ENTRIES+1):
+            self._logKeys.append({'zone': 'entry%iZone' % i, 'start': 'entry%iStart' % i, 
+                                  'run': 'entry%iRun' % i, 'adjust': 'entry%iAdjust' % i})
+            
+        # History part of the summary output along with the archive version 
+        # it was built from
+        self._summaryCache = None
+        
     def serialize(self, dt):
-        if isinstance(dt, datetime):
-            if dt.utcoffset() is not None:
-                dt = dt - dt.utcoffset()
+        if dt.tzinfo is not None:
+            offset = dt.utcoffset()
+            if offset is not None:
+                dt = dt - offset
         millis = int(calendar.timegm(dt.timetuple()) * 1000 + dt.microsecond / 1000)
         return millis
         
+    def _historySummary(self):
+        """
+        Return the start/run/adjust part of the summary output.  This is only
+        rebuilt when the archive changes, the run times of zones that are 
+        still running are filled in on every call.
+        """
+        
+        version = self.history.getVersion()
+        if self._summaryCache is None or self._summaryCache[0] != version:
+            output = {}
+            running = []
+            for i in xrange(1, len(self.hardwareZones)+1):
+                keys = self._keys[i-1]
+                entry = self.history.getLatestByZone(i)
+                if entry is not None:
+                    lStart = _serializeTimestamp(entry.dateTimeStart)
+                    output[keys['start']] = lStart
+                    output[keys['adjust']] = entry.wxAdjust
+                    if entry.dateTimeStop > 0:
+                        output[keys['run']] = _serializeTimestamp(entry.dateTimeStop)-lStart
+                    else:
+                        running.append( (keys['run'], lStart) )
+            self._summaryCache = (version, output, running)
+            
+        version, output, running = self._summaryCache
+        output = output.copy()
+        if running:
+            lStop = self.serialize(datetime.now())
+            for key,lStart in running:
+                output[key] = lStop-lStart
+                
+        return output
+        
     @cherrypy.expose
-    @cherrypy.tools.json_out()
+    @cherrypy.tools.json_out(handler=_jsonHandler)
     def summary(self):
-        output = {}
-
+        output = self._historySummary()
+        
         output['zones'] = []
-        for i,zone in enumerate(self.hardwareZones):
-            i += 1
-            output['status%i' % i] = 'on' if zone.isActive() else 'off'
-            output['name%i' % i] = self.config.get('Zone%i' % i, 'name')
+        zoneKeys = self._keys
+        zoneNames = self.config.getZoneNames()
+        for i,zone in enumerate(self.hardwareZones, 1):
+            keys = zoneKeys[i-1]
+            output[keys['status']] = _STATUS[zone.isActive()]
+            output[keys['name']] = zoneNames[i-1]
             output['zones'].append(i)
-        for entry in self.history.getData():
-            try:
-                output['start%i' % entry['zone']]
-                output['run%i' % entry['zone']]
-                output['adjust%i' % entry['zone']]
-            except KeyError:
-                lStart = datetime.fromtimestamp(entry['dateTimeStart'])
-                if entry['dateTimeStop'] > 0:
-                    lStop = datetime.fromtimestamp(entry['dateTimeStop'])
-                else:
-                    lStop = datetime.now()
-                output['start%i' % entry['zone']] = self.serialize(lStart)
-                output['run%i' % entry['zone']] = self.serialize(lStop)-self.serialize(lStart)
-                output['adjust%i' % entry['zone']] = entry['wxAdjust']
-                
+            
         return output
     
     @cherrypy.expose
-    @cherrypy.tools.json_out()
+    @cherrypy.tools.json_out(handler=_jsonHandler)
     def zone(self, id):
         output = {}
         
         try:
             id = int(id)
-            output['status'] = 'on' if self.hardwareZones[id-1].isActive() else 'off'
-            for entry in self.history.getData():
-                if entry['zone'] == id:
-                    output['lastStart'] = self.serialize(datetime.fromtimestamp(entry['dateTimeStart']))
-                    output['lastStop'] = self.serialize(datetime.fromtimestamp(entry['dateTimeStop']))
-                    output['adjust'] = entry['wxAdjust']
+            output['status'] = _STATUS[self.hardwareZones[id-1].isActive()]
+            entry = self.history.getLatestByZone(id)
+            if entry is not None:
+                output['lastStart'] = _serializeTimestamp(entry.dateTimeStart)
+                output['lastStop'] = _serializeTimestamp(entry.dateTimeStop)
+                output['adjust'] = entry.wxAdjust
                     
         except Exception, e:
             print str(e)
@@ -216,56 +398,53 @@ class AJAX(object):
         return output
         
     @cherrypy.expose
-    @cherrypy.tools.json_out()
+    @cherrypy.tools.json_out(handler=_jsonHandler)
     def control(self, **kwds):
         if len(kwds.keys()) > 0:
+            rows = []
             for keyword,value in kwds.iteritems():
-                if keyword[:4] == 'zone' and keyword.find('-') == -1:
-                    i = int(keyword[4:])
-                    if value == 'on' and not self.hardwareZones[i-1].isActive():
-                        self.hardwareZones[i-1].on()
-                        self.history.writeData(time.time(), i, 'on', wxAdjustment=-1.0)
-                    if value == 'off' and self.hardwareZones[i-1].isActive():
-                        self.hardwareZones[i-1].off()
-                        self.history.writeData(time.time(), i, 'off')
-                                    
+                i = self._zoneKws.get(keyword, None)
+                if i is None:
+                    continue
+                zone = self.hardwareZones[i-1]
+                active = zone.isActive()
+                if value == 'on' and not active:
+                    tStart = time.time()
+                    zone.on()
+                    rows.append( (tStart, i, 'on', -1.0) )
+                elif value == 'off' and active:
+                    tStop = time.time()
+                    zone.off()
+                    rows.append( (tStop, i, 'off', None) )
+            self.history.writeDataMany(rows)
+            
         output = {}
         output['zones'] = []
-        for i,zone in enumerate(self.hardwareZones):
-            i += 1
-            output['status%i' % i] = 'on' if zone.isActive() else 'off'
-            output['name%i' % i] = self.config.get('Zone%i' % i, 'name')
+        zoneKeys = self._keys
+        zoneNames = self.config.getZoneNames()
+        for i,zone in enumerate(self.hardwareZones, 1):
+            keys = zoneKeys[i-1]
+            output[keys['status']] = _STATUS[zone.isActive()]
+            output[keys['name']] = zoneNames[i-1]
             output['zones'].append(i)
             
         return output
         
     @cherrypy.expose
-    @cherrypy.tools.json_out()
+    @cherrypy.tools.json_out(handler=_jsonHandler)
     def log(self):
         output = {}
         
-        tNow = datetime.now()
-        history = self.history.getData(age=14*24*3600)[:25]
+        tNowUnix = time.time()
+        history = self.history.getData(age=14*24*3600, limit=MAX_LOG_ENTRIES)
         
-        output['tNow'] = self.serialize(tNow)
+        output['tNow'] = self.serialize(datetime.fromtimestamp(tNowUnix))
         output['entries'] = []
-        for i,entry in enumerate(history):
-            i += 1
-            output['entry%iZone' % i] = entry['zone']
-            output['entry%iStart' % i] = datetime.fromtimestamp(entry['dateTimeStart']).strftime("%Y-%m-%d %H:%M:%S")
-            if entry['dateTimeStop'] >= entry['dateTimeStart']:
-                active = False
-                runtime = entry['dateTimeStop'] - entry['dateTimeStart']
-            else:
-                active = True
-                runtime = time.time() - entry['dateTimeStart']
-            output['entry%iRun' % i] = "%i:%02i:%02i%s" % (runtime/3600, runtime%3600/60, runtime%60, " <i>(running)</i>" if active else "")
-            if entry['wxAdjust'] >= 0:
-                output['entry%iAdjust' % i] = "%i%%" % (100.0*entry['wxAdjust'],)
-            elif entry['wxAdjust'] == -1:
-                output['entry%iAdjust' % i] = 'Manual'
-            else:
-                output['entry%iAdjust' % i] = 'Disabled'
+        logKeys = self._logKeys
+        for i,entry in enumerate(history, 1):
+            keys = logKeys[i-1]
+            output[keys['zone']] = entry.zone
+            output[keys['start']], output[keys['run']], output[keys['adjust']] = _formatLogEntry(entry, tNowUnix)
             output['entries'].append(i)
             
         return output
@@ -273,67 +452,62 @@ class AJAX(object):
 
 # Main web interface
 class Interface(object):
-    def __init__(self, config, hardwareZones, history):
+    def __init__(self, config, hardwareZones, history, configSaver=None):
         self.config = config
         self.hardwareZones = hardwareZones
         self.history = history
+        self.configSaver = configSaver
         
         self.query = AJAX(config, hardwareZones, history)
         
+    def _saveConfig(self):
+        """
+        Save the configuration, handing it off to the background saver if 
+        there is one.
+        """
+        
+        if self.configSaver is not None:
+            self.configSaver.markDirty()
+        else:
+            saveConfig(CONFIG_FILE, self.config)
+            
     @cherrypy.expose
     def index(self):
         kwds = self.config.asDict()
         kwds['tNow'] = datetime.now()
-        kwds['tzOffset'] = int(datetime.now().strftime("%s")) - int(datetime.utcnow().strftime("%s"))
-        for i,zone in enumerate(self.hardwareZones):
-            i += 1
-            kwds['zone%i-status' % i] = 'on' if zone.isActive() else 'off'
-        for entry in self.history.getData():
-            try:
-                kwds['zone%i-lastStart' % entry['zone']]
-                kwds['zone%i-lastStop' % entry['zone']]
-                kwds['zone%i-adjust' % entry['zone']]
-            except KeyError:
-                kwds['zone%i-lastStart' % entry['zone']] = datetime.fromtimestamp(entry['dateTimeStart'])
-                kwds['zone%i-lastStop' % entry['zone']] = datetime.fromtimestamp(entry['dateTimeStop'])
-                kwds['zone%i-adjust' % entry['zone']] = entry['wxAdjust']
-                
-        template = jinjaEnv.get_template('index.html')
-        return template.render({'kwds':kwds})
+        kwds['tzOffset'] = _tzOffset()
+        
+        # The zone status is filled in by the page polling /query/summary
+        return _streamTemplate(INDEX_TMPL, kwds)
         
     @cherrypy.expose
     def zones(self, **kwds):
         if len(kwds) == 0:
             kwds = self.config.asDict()
         else:
-            self.config.fromDict(kwds)
-            saveConfig(CONFIG_FILE, self.config)
+            if self.config.fromDict(kwds):
+                self._saveConfig()
             
-        template = jinjaEnv.get_template('zones.html')
-        return template.render({'kwds':kwds})
+        return _streamTemplate(ZONES_TMPL, kwds)
     
     @cherrypy.expose
     def schedules(self, **kwds):
         if len(kwds) == 0:
             kwds = self.config.asDict()
         else:
-            self.config.fromDict(kwds)
-            saveConfig(CONFIG_FILE, self.config)
+            if self.config.fromDict(kwds):
+                self._saveConfig()
         kwds['tNow'] = datetime.now()
         
-        mname = {1:'January', 2:'February', 3:'March', 4:'April', 5:'May', 6:'June', 
-                 7:'July', 8:'August', 9:'September', 10:'October', 11:'November', 12:'December'}
-                 
-        template = jinjaEnv.get_template('schedules.html')
-        return template.render({'kwds':kwds, 'mname':mname})
+        return _streamTemplate(SCHEDULES_TMPL, kwds)
     
     @cherrypy.expose
     def weather(self, **kwds):
         if len(kwds) == 0:
             kwds = self.config.asDict()
         else:
-            self.config.fromDict(kwds)
-            saveConfig(CONFIG_FILE, self.config)
+            if self.config.fromDict(kwds):
+                self._saveConfig()
             
         if 'test-config' in kwds.keys():
             if kwds['weather-pws'] == '':
@@ -345,55 +519,56 @@ class Interface(object):
         else:
             kwds['weather-info'] = ''
             
-        template = jinjaEnv.get_template('weather.html')
-        return template.render({'kwds':kwds})
+        return _streamTemplate(WEATHER_TMPL, kwds)
     
     @cherrypy.expose
     def manual(self, **kwds):
         if len(kwds) == 0:
             kwds = self.config.asDict()
         else:
-            configDict = self.config.asDict()
-            for keyword,value in configDict.iteritems():
-                if keyword not in kwds.keys():
-                    kwds[keyword] = value
-                    
+            full = self.config.asDict()
+            full.update(kwds)
+            kwds = full
+            
+        rows = []
         for keyword,value in kwds.iteritems():
-            if keyword[:4] == 'zone' and keyword.find('-') == -1:
-                i = int(keyword[4:])
-                if value == 'on' and not self.hardwareZones[i-1].isActive():
-                    self.hardwareZones[i-1].on()
-                    self.history.writeData(time.time(), i, 'on', wxAdjustment=-1.0)
-                if value == 'off' and self.hardwareZones[i-1].isActive():
-                    self.hardwareZones[i-1].off()
-                    self.history.writeData(time.time(), i, 'off')
-                    
-        kwds['manual-info'] = ''
-        for i,zone in enumerate(self.hardwareZones):
-            i = i + 1
+            i = self.query._zoneKws.get(keyword, None)
+            if i is None:
+                continue
+            zone = self.hardwareZones[i-1]
+            active = zone.isActive()
+            if value == 'on' and not active:
+                tStart = time.time()
+                zone.on()
+                rows.append( (tStart, i, 'on', -1.0) )
+            elif value == 'off' and active:
+                tStop = time.time()
+                zone.off()
+                rows.append( (tStop, i, 'off', None) )
+        self.history.writeDataMany(rows)
+        
+        info = []
+        for i,zone in enumerate(self.hardwareZones, 1):
             if kwds['zone%i-enabled' % i] == 'on':
-                if zone.isActive():
-                    kwds['zone%i' % i] = 'selected'
-                    kwds['manual-info'] += 'Zone %i is turned on<br />' % i
-                else:
-                    kwds['zone%i' % i] = ''
-                    kwds['manual-info'] += 'Zone %i is turned off<br />' % i
+                active = zone.isActive()
+                kwds['zone%i' % i] = _SELECTED[active]
+                info.append( 'Zone %i is turned %s<br />' % (i, _STATUS[active]) )
+        kwds['manual-info'] = ''.join(info)
                 
-        template = jinjaEnv.get_template('manual.html')
-        return template.render({'kwds':kwds})
+        return _streamTemplate(MANUAL_TMPL, kwds)
         
     @cherrypy.expose
     def logs(self, **kwds):
         kwds = {}
-        kwds['tNow'] = datetime.now()
-        kwds['tzOffset'] = int(datetime.now().strftime("%s")) - int(datetime.utcnow().strftime("%s"))
-        kwds['history'] = self.history.getData(age=7*24*3600)[:25]
-        for i in xrange(len(kwds['history'])):
-            kwds['history'][i]['dateTimeStart'] = datetime.fromtimestamp(kwds['history'][i]['dateTimeStart'])
-            kwds['history'][i]['dateTimeStop'] = datetime.fromtimestamp(kwds['history'][i]['dateTimeStop'])
+        tNowUnix = time.time()
+        kwds['tNow'] = datetime.fromtimestamp(tNowUnix)
+        kwds['tzOffset'] = _tzOffset()
+        kwds['history'] = []
+        for entry in self.history.getData(age=7*24*3600, limit=MAX_LOG_ENTRIES):
+            start, run, adjust = _formatLogEntry(entry, tNowUnix)
+            kwds['history'].append({'zone':entry.zone, 'start':start, 'run':run, 'adjust':adjust})
             
-        template = jinjaEnv.get_template('log.html')
-        return template.render({'kwds':kwds})
+        return _streamTemplate(LOG_TMPL, kwds)
 
 
 def main(args):
@@ -404,7 +579,7 @@ def main(args):
     logger = logging.getLogger(__name__)
     logFormat = logging.Formatter('%(asctime)s [%(levelname)-8s] %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
     logFormat.converter = time.gmtime
-    logHandler = WatchedFileHandler(cmdConfig['logfile'])
+    logHandler = RotatingFileHandler(cmdConfig['logfile'], maxBytes=5*1024*1024, backupCount=2)
     logHandler.setFormatter(logFormat)
     logger.addHandler(logHandler)
     if cmdConfig['debug']:
@@ -419,11 +594,38 @@ def main(args):
         fh.close()
         
     # CherryPy configuration
-    cherrypy.config.update({'server.socket_host': '0.0.0.0', 'server.socket_port': 80, 'environment': 'production'})
-    cpConfig = {'/css': {'tools.staticdir.on': True,
-                         'tools.staticdir.dir': CSS_PATH},
+    ## A small thread pool is plenty for a Pi and the access log is not needed
+    cherrypy.config.update({'server.socket_host': '0.0.0.0', 
+                            'server.socket_port': 80, 
+                            'server.thread_pool': 8, 
+                            'server.socket_queue_size': 30, 
+                            'environment': 'production', 
+                            'engine.autoreload.on': False, 
+                            'log.screen': False, 
+                            'log.access_file': ''})
+    ## Pages are always encoded as UTF-8 and text responses, including the 
+    ## AJAX JSON, are gzipped for clients that accept it.  Static content is 
+    ## also served with a far-future expiration date and ETags so that 
+    ## browsers do not need to keep requesting it
+    cpConfig = {'/':    {'tools.encode.on': True,
+                         'tools.encode.encoding': 'utf-8',
+                         'tools.gzip.on': True,
+                         'tools.gzip.mime_types': ['text/*', 'application/json', 
+                                                   'application/javascript']},
+                '/css': {'tools.staticdir.on': True,
+                         'tools.staticdir.dir': CSS_PATH,
+                         'tools.staticdir.content_types': {'css': 'text/css'},
+                         'tools.expires.on': True,
+                         'tools.expires.secs': 365*24*3600,
+                         'tools.etags.on': True,
+                         'tools.etags.autotags': True},
                   '/js':  {'tools.staticdir.on': True,
-                           'tools.staticdir.dir': JS_PATH}
+                           'tools.staticdir.dir': JS_PATH,
+                           'tools.staticdir.content_types': {'js': 'application/javascript'},
+                           'tools.expires.on': True,
+                           'tools.expires.secs': 365*24*3600,
+                           'tools.etags.on': True,
+                           'tools.etags.autotags': True}
                   }
                 
     # Report on who we are
@@ -439,19 +641,24 @@ def main(args):
     
     # Initialize the hardware
     hardwareZones = initZones(config)
-    for previousRun in history.getData(scheduledOnly=True):
-        logger.info('Previous run of zone %i was on %s LT', previousRun['zone'], datetime.fromtimestamp(previousRun['dateTimeStart']))
+    for z,previousRun in sorted(history.getLastScheduledByZone().iteritems()):
+        if z < 1 or z > len(hardwareZones):
+            continue
+        logger.info('Previous run of zone %i was on %s LT', z, datetime.fromtimestamp(previousRun.dateTimeStart))
         
-        if hardwareZones[previousRun['zone']-1].lastStart == 0:
-            hardwareZones[previousRun['zone']-1].lastStart = previousRun['dateTimeStart']
-            hardwareZones[previousRun['zone']-1].lastStop = previousRun['dateTimeStop']
+        hardwareZones[z-1].lastStart = previousRun.dateTimeStart
+        hardwareZones[z-1].lastStop = previousRun.dateTimeStop
             
     # Initialize the scheduler
     bg = ScheduleProcessor(config, hardwareZones, history)
     bg.start()
     
+    # Initialize the background configuration saver
+    saver = ConfigSaver(cmdConfig['configFile'], config)
+    saver.start()
+    
     # Initialize the web interface
-    ws = Interface(config, hardwareZones, history)
+    ws = Interface(config, hardwareZones, history, configSaver=saver)
     #cherrypy.quickstart(ws, config=cpConfig)
     cherrypy.tree.mount(ws, "/", config=cpConfig)
     cherrypy.engine.start()
@@ -464,7 +671,7 @@ def main(args):
     bg.cancel()
     
     # Make sure the sprinkler zones are off
-    for i,zone in enumerate(hardwareZones):
+    for i,zone in enumerate(hardwareZones, 1):
         if zone.isActive():
             zone.off()
             history.writeData(time.time(), i, 'off')
@@ -473,6 +680,7 @@ def main(args):
     history.cancel()
     
     # Save the final configuration
+    saver.cancel()
     saveConfig(cmdConfig['configFile'], config)
 
 
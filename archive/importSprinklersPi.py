@@ -23,11 +23,7 @@ def main(args):
 	
 	toInsert = []
 	cursor.execute('SELECT * FROM zonelog ORDER BY date')
-	while True:
-		row = cursor.fetchone()
-		if row is None:
-			break
-			
+	for row in cursor:
 		start = row['date']
 		stop = start + row['duration']
 		zone = row['zone']
@@ -41,16 +37,12 @@ def main(args):
 	
 	# Open the Pi2O database and add the information if it doesn't already exist
 	conn = sqlite3.connect('pi2o-data.db')
-	conn.row_factory = dict_factory
 	cursor = conn.cursor()
 	
-	# Insert the data if it doesn't already exist
-	for hist in toInsert:
-		cursor.execute("SELECT * FROM pi2o WHERE dateTimeStart == %i and dateTimeStop == %i and zone == %i" % hist[:3])
-		row = cursor.fetchone()
-		if row is None:
-			cursor.execute("INSERT INTO pi2o (dateTimeStart,dateTimeStop,zone,wxAdjust) VALUES (%i,%i,%i,%f)" % hist)
-			
+	# Insert the data if it doesn't already exist.  dateTimeStart is the primary
+	# key so entries that are already in the database are skipped.
+	cursor.executemany("INSERT OR IGNORE INTO pi2o (dateTimeStart,dateTimeStop,zone,wxAdjust) VALUES (?,?,?,?)", toInsert)
+	
 	# Close it out
 	conn.commit()
 	conn.close()	
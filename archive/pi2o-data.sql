@@ -4,4 +4,5 @@ CREATE TABLE pi2o (
 	dateTimeStop INTEGER NOT NULL,
 	zone INTEGER NOT NULL,
 	wxAdjust REAL DEFAULT 1.0);
+CREATE INDEX pi2o_zone_start ON pi2o (zone, dateTimeStart DESC);
 COMMIT;
@@ -5,14 +5,16 @@ File for dealing with the configuration of Pi2O.py.
 """
 
 import os
+import time
 import logging
 import threading
-from ConfigParser import SafeConfigParser, NoSectionError
+from ConfigParser import SafeConfigParser
 
 from zone import GPIORelay, GPIORainSensor, NullRainSensor, SoftRainSensor, SprinklerZone
 
 __version__ = '0.4'
-__all__ = ['CONFIG_FILE', 'LockingConfigParser', 'loadConfig', 'initZones', 'saveConfig', '__version__', '__all__']
+__all__ = ['CONFIG_FILE', 'LockingConfigParser', 'loadConfig', 'initZones', 'saveConfig', 
+           'ConfigSaver', '__version__', '__all__']
 
 
 # Logger instance
@@ -33,27 +35,77 @@ CONFIG_FILE = os.path.join(_BASE_PATH, 'Pi2O.config')
 
 class LockingConfigParser(SafeConfigParser):
     """
-    Sub-class of ConfigParser.SafeConfigParser that wraps the get, set, and 
-    write methods with a semaphore to ensure that only one get/set/read/write 
-    happens at a time.  The sub-class also adds asDict and fromDict methods
-    to make it easier to tie the configuration into webforms.
+    Sub-class of ConfigParser.SafeConfigParser that wraps the set, read, and 
+    write methods with a re-entrant lock to ensure that only one update or 
+    write happens at a time.  Reads are not locked.  The sub-class also adds
+    asDict and fromDict methods to make it easier to tie the configuration 
+    into webforms.
     """
     
-    _lock = threading.Semaphore()
-    
-    def get(self, *args, **kwds):
+    def __init__(self, *args, **kwds):
+        SafeConfigParser.__init__(self, *args, **kwds)
+        
+        # Lock for anything that changes or walks the configuration
+        self._lock = threading.RLock()
+        
+        # Cached output of asDict(), getZoneNames(), and get() and a counter 
+        # that is bumped every time the configuration changes
+        self._version = 0
+        self._dictCache = None
+        self._zoneNames = None
+        self._snapshot = None
+        
+        # Hash of the configuration as it was last read from/written to disk
+        self._lastSavedHash = None
+        
+    def _invalidate(self):
+        """
+        Mark any cached views of the configuration as stale.
+        """
+        
+        self._version += 1
+        self._dictCache = None
+        self._zoneNames = None
+        self._snapshot = None
+        
+    def _getSnapshot(self):
         """
-        Locked get() method.
+        Return a dictionary of the interpolated configuration values keyed by
+        (section, option).  The dictionary is built once per configuration 
+        change.
         """
         
-        #self._lock.acquire()
-        value = SafeConfigParser.get(self, *args, **kwds)
-        #self._lock.release()
+        snapshot = self._snapshot
+        if snapshot is None:
+            with self._lock:
+                snapshot = {}
+                for section in self.sections():
+                    for keyword,value in self.items(section):
+                        snapshot[(section, keyword)] = value
+                self._snapshot = snapshot
+                
+        # Done
+        return snapshot
+        
+    def get(self, section, option, raw=False, vars=None):
+        """
+        get() method that serves plain lookups from the snapshot of the 
+        configuration.  Raw lookups, lookups with extra variables, and 
+        anything not found in the snapshot go through SafeConfigParser so 
+        that the usual exceptions are raised.
+        """
+        
+        if not raw and vars is None:
+            try:
+                return self._getSnapshot()[(section, self.optionxform(option))]
+            except KeyError:
+                pass
+        value = SafeConfigParser.get(self, section, option, raw=raw, vars=vars)
         return value
         
     def getint(self, *args, **kwds):
         """
-        Locked getint() method.
+        getint() method.
         """
         
         value = SafeConfigParser.getint(self, *args, **kwds)
@@ -61,7 +113,7 @@ class LockingConfigParser(SafeConfigParser):
         
     def getfloat(self, *args, **kwds):
         """
-        Locked getfloat() method.
+        getfloat() method.
         """
         
         value = SafeConfigParser.getfloat(self, *args, **kwds)
@@ -72,59 +124,139 @@ class LockingConfigParser(SafeConfigParser):
         Locked set() method.
         """
         
-        #self._lock.acquire()
-        SafeConfigParser.set(self, *args, **kwds)
-        #self._lock.release()
+        with self._lock:
+            SafeConfigParser.set(self, *args, **kwds)
+            self._invalidate()
         
     def read(self, *args, **kwds):
         """
         Locked read() method.
         """
         
-        SafeConfigParser.read(self, *args, **kwds)
+        with self._lock:
+            filesRead = SafeConfigParser.read(self, *args, **kwds)
+            self._invalidate()
+        return filesRead
         
     def write(self, *args, **kwds):
         """
         Locked write() method.
         """
         
-        SafeConfigParser.write(self, *args, **kwds)
+        with self._lock:
+            SafeConfigParser.write(self, *args, **kwds)
         
+    def readDict(self, sections):
+        """
+        Given a sequence of (section, options) pairs, where options is itself
+        a sequence of (option, value) pairs, add any missing sections and set
+        the options in one locked pass.  This is the Python 2 equivalent of 
+        read_dict() in the Python 3 configparser.
+        """
+        
+        with self._lock:
+            for section,options in sections:
+                if not self.has_section(section):
+                    self.add_section(section)
+                for keyword,value in options:
+                    SafeConfigParser.set(self, section, keyword, value)
+            self._invalidate()
+            
     def asDict(self):
         """
         Return the configuration as a dictionary with keys structured as
-        section-option.
+        section-option.  The dictionary is built once per configuration 
+        change and a shallow copy of it is returned so that callers are free
+        to modify it.
         """
         
-        configDict = {}
-        for section in self.sections():
-            for keyword,value in self.items(section):
-                configDict['%s-%s' % (section.lower(), keyword.replace('_', '-'))] = value
+        configDict = self._dictCache
+        if configDict is None:
+            with self._lock:
+                configDict = {}
+                for section in self.sections():
+                    for keyword,value in self.items(section):
+                        configDict['%s-%s' % (section.lower(), keyword.replace('_', '-'))] = value
+                self._dictCache = configDict
+                
+        # Done
+        return configDict.copy()
         
+    def getZoneNames(self):
+        """
+        Return a tuple of the zone names ordered by zone number.  The tuple is 
+        rebuilt only when the configuration changes.
+        """
+        
+        zoneNames = self._zoneNames
+        if zoneNames is None:
+            with self._lock:
+                zoneNames = []
+                zone = 1
+                while self.has_section('Zone%i' % zone):
+                    zoneNames.append( self.get('Zone%i' % zone, 'name') )
+                    zone += 1
+                zoneNames = tuple(zoneNames)
+                self._zoneNames = zoneNames
+                
         # Done
-        return configDict
+        return zoneNames
+        
+    def getZoneCount(self):
+        """
+        Return the number of zones, i.e., the number of consecutively 
+        numbered zone sections starting with Zone1.
+        """
+        
+        return len(self.getZoneNames())
         
     def fromDict(self, configDict):
         """
         Given a dictionary created by asDict(), update the configuration 
-        as needed.
+        as needed.  Returns True if any of the values were changed, False
+        otherwise.
         """
         
-        # Loop over the pairs in the dictionary
-        for key,value in configDict.iteritems():
-            try:
-                section, keyword = key.split('-', 1)
-                keyword = keyword.replace('-', '_')
-                section = section.capitalize()
-                if section == 'Rainsensor':
-                    section = 'RainSensor'
-                self.set(section, keyword, value)
-            except Exception, e:
-                print str(e)
-                pass
+        # Loop over the pairs in the dictionary, reading in the current values
+        # one section at a time.  The lock is held throughout so that the 
+        # form is applied as a whole and the cached views are only cleared 
+        # once at the end.
+        changed = False
+        current = {}
+        with self._lock:
+            canonical = dict((section.lower(), section) for section in self.sections())
+            for key,value in configDict.iteritems():
+                try:
+                    section, keyword = key.split('-', 1)
+                    keyword = keyword.replace('-', '_')
+                    section = canonical.get(section, None) or section.capitalize()
+                    try:
+                        options = current[section]
+                    except KeyError:
+                        options = {}
+                        if self.has_section(section):
+                            options = dict(self.items(section, raw=True))
+                        current[section] = options
+                    if options.get(keyword, None) == value:
+                        continue
+                    SafeConfigParser.set(self, section, keyword, value)
+                    changed = True
+                except Exception, e:
+                    print str(e)
+                    pass
+                    
+            if changed:
+                self._invalidate()
                 
         # Done
-        return True
+        return changed
+        
+    def getHash(self):
+        """
+        Return a hash of the current configuration.
+        """
+        
+        return hash(frozenset(self.asDict().iteritems()))
 
 
 def loadConfig(filename):
@@ -139,21 +271,15 @@ def loadConfig(filename):
     ##  1) name - zone nickname
     ##  2) pin - RPi GPIO pin
     ##  3) enabled - whether or not the zone is active
+    defaults = []
     for zone in xrange(1, MAX_ZONES+1):
-        config.add_section('Zone%i' % zone)
-        for keyword in ('name', 'pin', 'enabled'):
-            config.set('Zone%i' % zone, keyword, '')
-            if keyword == 'enabled':
-                config.set('Zone%i' % zone, keyword, 'off')
-                
+        defaults.append( ('Zone%i' % zone, (('name', ''), ('pin', ''), ('enabled', 'off'))) )
+        
     ## Dummy rain sensor information
     ##  1) type - off, software, or hardware
     ##  2) pin - RPi GPIO pin for the hardware rain sensor
     ##  3) precip - precipitation cutoff for the software rain sensor
-    config.add_section('RainSensor')
-    config.set('RainSensor', 'type', 'off')
-    config.set('RainSensor', 'pin', '')
-    config.set('RainSensor', 'precip', '')
+    defaults.append( ('RainSensor', (('type', 'off'), ('pin', ''), ('precip', ''))) )
     
     ## Dummy schedule information - one for each month
     ##  1) start - start time as HH:MM, 24-hour format
@@ -162,31 +288,23 @@ def loadConfig(filename):
     ##  4) enabled - whether or not the schedule is active
     ##  5) wxadjust - whether or not weather adjustments should be applied
     for month in xrange(1, 13):
-        config.add_section('Schedule%i' % month)
-        for keyword in ('start', 'duration', 'interval', 'enabled', 'wxadjust'):
-            if keyword == 'duration':
-                for zone in xrange(1, MAX_ZONES+1):
-                    config.set('Schedule%i' % month, '%s%i' % (keyword, zone), '')
-            else:
-                config.set('Schedule%i' % month, keyword, '')
-            if keyword in ('enabled', 'wxadjust'):
-                config.set('Schedule%i' % month, keyword, 'off')
-                
+        options = [('start', '')]
+        options.extend( [('duration%i' % zone, '') for zone in xrange(1, MAX_ZONES+1)] )
+        options.extend( [('interval', ''), ('enabled', 'off'), ('wxadjust', 'off')] )
+        defaults.append( ('Schedule%i' % month, options) )
+        
     ## Dummy weather station information
     ##  1) pws - PWS ID to use for weather info
     ##  2) max_adjust - maximum weather adjustment percentage
     ##  3) enabled - whether or not use to WUnderground
-    config.add_section('Weather')
-    for keyword in ('pws', 'max_adjust', 'enabled'):
-        config.set('Weather', keyword, '')
-        if keyword == 'enabled':
-            config.set('Weather', keyword, 'off')
-        if keyword == 'max_adjust':
-            config.set('Weather', keyword, '200')
-            
+    defaults.append( ('Weather', (('pws', ''), ('max_adjust', '200'), ('enabled', 'off'))) )
+    
+    config.readDict(defaults)
+    
     # Try to read in the actual configuration file
     try:
-        config.read(filename)
+        if config.read(filename):
+            config._lastSavedHash = config.getHash()
         confLogger.info('Loaded configuration from \'%s\'', os.path.basename(filename))
         
     except:
@@ -203,36 +321,29 @@ def initZones(config):
     """
     
     # Initialize the rain sensor
-    if config.get('RainSensor', 'type') == 'off':
+    sensorType = config.get('RainSensor', 'type')
+    if sensorType == 'off':
         rainSensor = NullRainSensor()
-    elif config.get('RainSensor', 'type') == 'software':
+    elif sensorType == 'software':
         rainSensor = SoftRainSensor( config.getfloat('RainSensor', 'precip'), config )
     else:
         rainSensor = GPIORainSensor( config.getint('RainSensor', 'pin') )
         
-    # Create the list of SprinklerZone instances
+    # Create the list of SprinklerZone instances, one for each zone section
     zones = []
-    zone = 1
-    while True:
-        try:
-            ## Is the zone enabled?
-            zoneEnabled = config.get('Zone%i' % zone, 'enabled')
-            if zoneEnabled == 'on':
-                ### If so, use the real GPIO pin
-                zonePin = config.getint('Zone%i' % zone, 'pin')
-                ### If not, use a dummy pin
-            else:
-                zonePin = -1
-                
-            ## Create the SprinklerZone instance
-            zones.append( SprinklerZone(zonePin, rainSensor=rainSensor) )
-            
-            ## Update the counter
-            zone += 1
-            
-        except NoSectionError:
-            break
+    for zone in xrange(1, config.getZoneCount()+1):
+        ## Is the zone enabled?
+        options = dict(config.items('Zone%i' % zone))
+        if options['enabled'] == 'on':
+            ### If so, use the real GPIO pin
+            zonePin = int(options['pin'])
+        else:
+            ### If not, use a dummy pin
+            zonePin = -1
             
+        ## Create the SprinklerZone instance
+        zones.append( SprinklerZone(zonePin, rainSensor=rainSensor) )
+        
     # Done
     return zones
 
@@ -240,11 +351,87 @@ def initZones(config):
 def saveConfig(filename, config):
     """
     Given a filename and a LockingConfigParser, write the configuration to 
-    disk.
+    disk.  The write is skipped if nothing has changed since the last time
+    the configuration was loaded or saved.
     """
     
-    fh = open(filename, 'w')
+    configHash = config.getHash()
+    if configHash == config._lastSavedHash:
+        confLogger.debug('Configuration unchanged, not saving to \'%s\'', os.path.basename(filename))
+        return
+        
+    # Write to a temporary file first and then move it into place so that an
+    # interrupted write cannot leave a partial configuration behind
+    tempname = filename+'.tmp'
+    fh = open(tempname, 'w')
     config.write(fh)
+    fh.flush()
+    os.fsync(fh.fileno())
     fh.close()
+    os.rename(tempname, filename)
+    config._lastSavedHash = configHash
     
     confLogger.info('Saved configuration to \'%s\'', os.path.basename(filename))
+
+
+class ConfigSaver(object):
+    """
+    Class responsible for writing the configuration to disk in the background
+    so that the web interface does not need to wait on it.  Calls to 
+    markDirty() that arrive within 'delay' seconds of each other are 
+    collapsed into a single save.
+    """
+    
+    def __init__(self, filename, config, delay=2.0):
+        self.filename = filename
+        self.config = config
+        self.delay = float(delay)
+        
+        self.thread = None
+        self.alive = threading.Event()
+        self.dirty = threading.Event()
+        
+    def start(self):
+        if self.thread is not None:
+            self.cancel()
+            
+        self.thread = threading.Thread(target=self.run, name='configSaver')
+        self.thread.setDaemon(1)
+        self.alive.set()
+        self.thread.start()
+        
+        confLogger.info('Started the ConfigSaver background thread')
+        
+    def cancel(self):
+        if self.thread is not None:
+            self.alive.clear()          # clear alive event for thread
+            self.dirty.set()            # wake the thread so that it exits
+            self.thread.join()
+            
+        # Save anything that is still outstanding
+        self._save()
+        
+        confLogger.info('Stopped the ConfigSaver background thread')
+        
+    def markDirty(self):
+        """
+        Flag the configuration as needing to be saved.
+        """
+        
+        self.dirty.set()
+        
+    def _save(self):
+        if self.dirty.isSet():
+            self.dirty.clear()
+            try:
+                saveConfig(self.filename, self.config)
+            except Exception, e:
+                confLogger.error('Failed to save configuration to \'%s\': %s', os.path.basename(self.filename), str(e))
+                
+    def run(self):
+        while self.alive.isSet():
+            self.dirty.wait()
+            if self.dirty.isSet() and self.alive.isSet():
+                ## Give any other changes a chance to arrive
+                time.sleep(self.delay)
+            self._save()
@@ -13,20 +13,84 @@ import logging
 import sqlite3
 import threading
 import traceback
-from ConfigParser import NoSectionError
+from collections import namedtuple, deque
 try:
 	import cStringIO as StringIO
 except ImportError:
 	import StringIO
 	
 __version__ = "0.2"
-__all__ = ["Archive", "__version__", "__all__"]
+__all__ = ["HistoryRow", "Archive", "__version__", "__all__"]
 
 
 # Logger instance
 dbLogger = logging.getLogger('__main__')
 
 
+# Per-connection tuning for a read-mostly workload
+_CONNECTION_PRAGMAS = ('synchronous=NORMAL', 'cache_size=-65536', 'temp_store=MEMORY', 
+                       'mmap_size=268435456', 'busy_timeout=5000')
+
+
+# SQL for writing entries to the archive.  The values are bound as parameters
+# so that sqlite3 can reuse the compiled statements.
+_INSERT_SQL = 'INSERT INTO pi2o (dateTimeStart,dateTimeStop,zone,wxAdjust) VALUES (?,?,?,?)'
+_CLOSE_SQL = 'UPDATE pi2o SET dateTimeStop = ? WHERE zone == ? AND dateTimeStop == 0'
+
+
+# Queue marker that tells the DatabaseProcessor thread to exit
+_STOP = object()
+
+
+# How long, in seconds, the results of Archive.getData() are reused for
+_DATA_CACHE_AGE = 0.5
+
+
+# A single entry in the archive
+HistoryRow = namedtuple('HistoryRow', ['dateTimeStart', 'dateTimeStop', 'zone', 'wxAdjust'])
+
+## Column list to use when selecting HistoryRow entries
+_HISTORY_COLUMNS = 'dateTimeStart,dateTimeStop,zone,wxAdjust'
+
+## SQL for the most recent entry, and the most recent scheduled entry, for a
+## zone
+_LATEST_SQL = 'SELECT %s FROM pi2o WHERE zone == ? ORDER BY dateTimeStart DESC LIMIT 1' % _HISTORY_COLUMNS
+_LAST_SCHEDULED_SQL = 'SELECT %s FROM pi2o WHERE zone == ? AND (wxAdjust >= 0.0 OR wxAdjust <= -1.5) ORDER BY dateTimeStart DESC LIMIT 1' % _HISTORY_COLUMNS
+
+
+def _dictFactory(cursor, row):
+	"""
+	sqlite3 row factory that returns each row as a dictionary.
+	"""
+	
+	d = {}
+	for idx, col in enumerate(cursor.description):
+		d[col[0]] = row[idx]
+	return d
+
+
+def _historyRowFactory(cursor, row):
+	"""
+	sqlite3 row factory that returns each row as a HistoryRow.  This requires
+	that the query select the _HISTORY_COLUMNS in order.
+	"""
+	
+	return HistoryRow._make(row)
+
+
+def _openConnection(dbName, rowFactory=_dictFactory):
+	"""
+	Open a connection to the specified database that returns rows using the
+	provided row factory and has the connection PRAGMAs applied.
+	"""
+	
+	conn = sqlite3.connect(dbName, cached_statements=256)
+	conn.row_factory = rowFactory
+	for pragma in _CONNECTION_PRAGMAS:
+		conn.execute('PRAGMA %s' % pragma)
+	return conn
+
+
 class DatabaseProcessor(threading.Thread):
 	"""
 	Class responsible for providing access to the database from a single thread.
@@ -52,19 +116,43 @@ class DatabaseProcessor(threading.Thread):
 		
 		dbLogger.info('Started the DatabaseProcessor background thread')
 		
-	def cancel(self):
+	def cancel(self, callback=None):
+		"""
+		Stop the background thread once everything already queued is done.
+		The optional 'callback' is called with no arguments from the thread 
+		just before it exits.
+		"""
+		
 		if self.thread is not None:
 			self.alive.clear()          # clear alive event for thread
+			self.input.put( (_STOP,None,callback) )
 			self.thread.join()
 			
 		dbLogger.info('Stopped the DatabaseProcessor background thread')
 			
-	def appendRequest(self, cmd):
+	def appendRequest(self, cmd, params=()):
+		"""
+		Queue a command and return the request ID to pass to getResponse().
+		The command is either a single SQL statement, with any values bound
+		through 'params', or a list of (SQL, parameters) commands that is 
+		committed as a single transaction.
+		"""
+		
 		rid = str(uuid.uuid4())
-		self.input.put( (rid,cmd) )
+		self.input.put( (rid,cmd,params) )
 		
 		return rid
 		
+	def appendWrite(self, cmds, callback=None):
+		"""
+		Queue a list of (SQL, parameters) commands to be committed as a single
+		transaction without waiting for them to finish.  The optional 
+		'callback' is called with no arguments from the DatabaseProcessor 
+		thread once the write has been committed or has failed.
+		"""
+		
+		self.input.put( (None,cmds,callback) )
+		
 	def getResponse(self, rid):
 		qid, qresp = self.output.get()
 		while qid != rid:
@@ -73,21 +161,74 @@ class DatabaseProcessor(threading.Thread):
 			
 		return qresp
 		
-	def dict_factory(self, cursor, row):
-		d = {}
-		for idx, col in enumerate(cursor.description):
-			d[col[0]] = row[idx]
-		return d
-		
 	def run(self):
-		self._dbConn = sqlite3.connect(self._dbName)
-		self._dbConn.row_factory = self.dict_factory
+		self._dbConn = _openConnection(self._dbName)
 		self._cursor = self._dbConn.cursor()
 		
-		while self.alive.isSet() or not self.input.empty():
+		# Use WAL mode so that readers on other connections do not block this one
+		self._cursor.execute('PRAGMA journal_mode=WAL')
+		
+		# Make sure the latest entry per zone lookup is indexed
+		self._cursor.execute('CREATE INDEX IF NOT EXISTS pi2o_zone_start ON pi2o (zone, dateTimeStart DESC)')
+		self._dbConn.commit()
+		
+		# Have the implicit transactions that sqlite3 opens for writes take 
+		# the write lock up front with BEGIN IMMEDIATE
+		self._dbConn.isolation_level = 'IMMEDIATE'
+		
+		pending = None
+		while True:
 			try:
-				rid, cmd = self.input.get()
-				self._cursor.execute(cmd)
+				if pending is not None:
+					rid, cmd, params = pending
+					pending = None
+				else:
+					## Block until there is something to do.  cancel() queues
+					## _STOP after everything else so that any queued writes
+					## are committed before the thread exits.
+					rid, cmd, params = self.input.get()
+					
+				if rid is _STOP:
+					if params is not None:
+						params()
+					break
+					
+				if rid is None:
+					## Queued writes - gather up the others that are already 
+					## waiting and commit them all at once.  For these the 
+					## third element is the callback rather than parameters.
+					batches = [cmd,]
+					callbacks = [params,]
+					while True:
+						try:
+							nrid, ncmd, nparams = self.input.get_nowait()
+						except Queue.Empty:
+							break
+						if nrid is None:
+							batches.append( ncmd )
+							callbacks.append( nparams )
+						else:
+							pending = (nrid, ncmd, nparams)
+							break
+					try:
+						self._commitWrites(batches)
+					finally:
+						for callback in callbacks:
+							if callback is not None:
+								callback()
+					continue
+					
+				if isinstance(cmd, (list, tuple)):
+					## A batch of writes that is committed as a single 
+					## transaction.  The reply is always sent so that the 
+					## caller is not left waiting if the write fails.
+					try:
+						self._commitWrites([cmd,])
+					finally:
+						self.output.put( (rid,[]) )
+					continue
+					
+				self._cursor.execute(cmd, params)
 				output = []
 				for row in self._cursor.fetchall():
 					output.append( row )
@@ -99,15 +240,54 @@ class DatabaseProcessor(threading.Thread):
 				exc_type, exc_value, exc_traceback = sys.exc_info()
 				dbLogger.error("DatabaseProcessor: %s at line %i", e, traceback.tb_lineno(exc_traceback))
 				## Grab the full traceback and save it to a string via StringIO
-                fileObject = StringIO.StringIO()
-                traceback.print_tb(exc_traceback, file=fileObject)
-                tbString = fileObject.getvalue()
-                fileObject.close()
-                ## Print the traceback to the logger as a series of DEBUG messages
-                for line in tbString.split('\n'):
-                	dbLogger.debug("%s", line)
+				fileObject = StringIO.StringIO()
+				traceback.print_tb(exc_traceback, file=fileObject)
+				tbString = fileObject.getvalue()
+				fileObject.close()
+				## Print the traceback to the logger as a series of DEBUG messages
+				for line in tbString.split('\n'):
+					dbLogger.debug("%s", line)
 					
 		self._dbConn.close()
+		
+	def _commitWrites(self, batches):
+		"""
+		Commit a list of write batches, each a list of (SQL, parameters) 
+		commands, in a single transaction.  If that fails each batch is 
+		retried in its own transaction so that one bad batch does not take 
+		the others with it.
+		"""
+		
+		try:
+			for cmds in batches:
+				self._executeWrites(cmds)
+			self._dbConn.commit()
+		except Exception:
+			self._dbConn.rollback()
+			if len(batches) == 1:
+				raise
+				
+			for cmds in batches:
+				try:
+					self._executeWrites(cmds)
+					self._dbConn.commit()
+				except Exception, e:
+					self._dbConn.rollback()
+					dbLogger.error("DatabaseProcessor: failed to write %s: %s", cmds, e)
+					
+	def _executeWrites(self, cmds):
+		"""
+		Execute a list of (SQL, parameters) commands in the current 
+		transaction.  A constraint violation only undoes the statement that
+		caused it so it is logged and skipped rather than taking the rest of 
+		the transaction with it.
+		"""
+		
+		for sql,params in cmds:
+			try:
+				self._cursor.execute(sql, params)
+			except sqlite3.IntegrityError, e:
+				dbLogger.error("DatabaseProcessor: skipping write %s %s: %s", sql, params, e)
 
 
 class Archive(object):
@@ -121,29 +301,25 @@ class Archive(object):
 			raise RuntimeError("Archive database not found")
 		self._backend = None
 		
+		# Per-thread read connections
+		self._tls = threading.local()
+		
+		# Most recent entry for each zone, keyed by zone number, and a counter
+		# that is bumped every time the archive is written to
+		self._latestByZone = {}
+		self._version = 0
+		
+		# Recently used start times so that entries written within the same 
+		# second do not collide on the dateTimeStart primary key
+		self._recentStarts = deque(maxlen=32)
+		self._startLock = threading.Lock()
+		
+		# Recent getData() results keyed by the query arguments.  Each value
+		# is a (version, time, rows) tuple.
+		self._dataCache = {}
+		
 		# Figure out how many zones there are
-		zones = []
-		zone = 1
-		while True:
-			try:
-				## Is the zone enabled?
-				zoneEnabled = config.get('Zone%i' % zone, 'enabled')
-				if zoneEnabled == 'on':
-					### If so, use the real GPIO pin
-					zonePin = config.getint('Zone%i' % zone, 'pin')
-					### If not, use a dummy pin
-				else:
-					zonePin = -1
-				
-				## Create the SprinklerZone instance
-				zones.append( zonePin )
-			
-				## Update the counter
-				zone += 1
-			
-			except NoSectionError:
-				break
-		self.nZones = len(zones)
+		self.nZones = config.getZoneCount()
     	
 	def start(self):
 		"""
@@ -154,62 +330,206 @@ class Archive(object):
 			self._backend = DatabaseProcessor(self._dbName)
 		self._backend.start()
 		
+		# Prime the latest entry index
+		self._latestByZone = {}
+		for zone in xrange(1, self.nZones+1):
+			output = self._conn().execute(_LATEST_SQL, (zone,)).fetchall()
+			if len(output) > 0:
+				self._latestByZone[zone] = output[0]
+				self._recentStarts.append( output[0].dateTimeStart )
+		self._version += 1
+		
 	def cancel(self):
 		"""
-		Close the database.
+		Close the database.  Any queued writes are committed first.
 		"""
 	
 		if self._backend is not None:
-			self._backend.cancel()
+			self._backend.cancel(callback=self._closeConn)
 			
-	def getData(self, age=0, scheduledOnly=False):
+	def _conn(self):
 		"""
-		Return a collection of data a certain number of seconds into the past.
+		Return the read connection for the current thread, opening it if 
+		needed.  All writes go through the DatabaseProcessor so these 
+		connections are marked as query only.  Rows read from this 
+		connection are returned as HistoryRow instances.
 		"""
-	
+		
+		try:
+			conn = self._tls.conn
+		except AttributeError:
+			conn = _openConnection(self._dbName, rowFactory=_historyRowFactory)
+			conn.execute('PRAGMA query_only=ON')
+			self._tls.conn = conn
+		return conn
+		
+	def _closeConn(self):
+		"""
+		Close the read connection for the current thread, if there is one.
+		The DatabaseProcessor thread opens one when refreshing the latest 
+		entries and this closes it before the thread exits rather than 
+		leaving it to be cleaned up during interpreter shutdown.
+		"""
+		
+		try:
+			conn = self._tls.conn
+		except AttributeError:
+			return
+		del self._tls.conn
+		conn.close()
+		
+	def getData(self, age=0, limit=None, offset=0, scheduledOnly=False):
+		"""
+		Return a list of HistoryRow entries a certain number of seconds into 
+		the past.  The optional 'limit' and 'offset' keywords control how 
+		many of the most recent entries are returned.  The results are 
+		reused for _DATA_CACHE_AGE seconds, or until a write to the archive
+		has been committed, so that pages polled at the same time share one
+		query.
+		"""
+		
+		# Check for a recent copy of the results
+		key = (age, limit, offset, scheduledOnly)
+		version = self._version
+		tNow = time.time()
+		try:
+			cVersion, cTime, output = self._dataCache[key]
+			if cVersion == version and tNow - cTime < _DATA_CACHE_AGE:
+				return list(output)
+		except KeyError:
+			pass
+			
 		# Fetch the entries that match
+		params = []
 		if age <= 0:
 			if scheduledOnly:
-				sqlCmd = 'SELECT * FROM pi2o WHERE wxAdjust >= 0.0 OR wxAdjust <= -1.5 ORDER BY dateTimeStart DESC LIMIT %i' % self.nZones
+				sqlCmd = 'SELECT %s FROM pi2o WHERE wxAdjust >= 0.0 OR wxAdjust <= -1.5 ORDER BY dateTimeStart DESC' % _HISTORY_COLUMNS
 			else:
-				sqlCmd = 'SELECT * FROM pi2o GROUP BY zone ORDER BY dateTimeStart DESC LIMIT %i' % self.nZones
-			rid = self._backend.appendRequest(sqlCmd)
+				sqlCmd = 'SELECT %s FROM pi2o GROUP BY zone ORDER BY dateTimeStart DESC' % _HISTORY_COLUMNS
+			if limit is None:
+				limit = self.nZones
 		else:
 			# Figure out how far to look back into the database
-			tNow = time.time()
 			tLookback = tNow - age
 			if scheduledOnly:
-				sqlCmd = 'SELECT * FROM pi2o WHERE dateTimeStart >= %i AND (wxAdjust >= 0.0 OR wxAdjust <= -1.5) ORDER BY dateTimeStart DESC' % tLookback
+				sqlCmd = 'SELECT %s FROM pi2o WHERE dateTimeStart >= ? AND (wxAdjust >= 0.0 OR wxAdjust <= -1.5) ORDER BY dateTimeStart DESC' % _HISTORY_COLUMNS
 			else:
-				sqlCmd = 'SELECT * FROM pi2o WHERE dateTimeStart >= %i ORDER BY dateTimeStart DESC' % tLookback
-			rid = self._backend.appendRequest(sqlCmd)
+				sqlCmd = 'SELECT %s FROM pi2o WHERE dateTimeStart >= ? ORDER BY dateTimeStart DESC' % _HISTORY_COLUMNS
+			params.append( int(tLookback) )
+		if limit is not None:
+			sqlCmd += ' LIMIT ? OFFSET ?'
+			params.extend( (limit, offset) )
 			
 		# Fetch the output
-		output = self._backend.getResponse(rid)
+		output = self._conn().execute(sqlCmd, params).fetchall()
+		self._dataCache[key] = (version, tNow, output)
 		
 		# Done
-		return output
+		return list(output)
+		
+	def getLatestByZone(self, zone):
+		"""
+		Return the most recent HistoryRow for the specified zone or None if 
+		the zone has never been run.
+		"""
+		
+		return self._latestByZone.get(zone, None)
 			
-	def writeData(self, timestamp, zone, status, wxAdjustment=None):
+	def getLastScheduledByZone(self):
+		"""
+		Return a dictionary, keyed by zone number, of the most recent 
+		scheduled HistoryRow for each zone.  Zones that have never had a 
+		scheduled run are not included.
+		"""
+		
+		conn = self._conn()
+		
+		output = {}
+		for zone in xrange(1, self.nZones+1):
+			rows = conn.execute(_LAST_SCHEDULED_SQL, (zone,)).fetchall()
+			if len(rows) > 0:
+				output[zone] = rows[0]
+				
+		return output
+		
+	def getVersion(self):
+		"""
+		Return a counter that changes every time the archive is updated.
+		"""
+		
+		return self._version
+		
+	def writeData(self, timestamp, zone, status, wxAdjustment=None, wait=False):
 		"""
 		Write a collection of data to the database.
 		"""
 		
-		# Validate
-		if status not in ('on', 'off'):
-			raise ValueError("Invalid status code '%s'" % status)
-		if wxAdjustment is None:
-			wxAdjustment = 1.0
+		return self.writeDataMany([(timestamp, zone, status, wxAdjustment),], wait=wait)
+		
+	def writeDataMany(self, rows, wait=False):
+		"""
+		Write a list of (timestamp, zone, status, wxAdjustment) entries to 
+		the database in a single transaction.  The write is queued for the 
+		DatabaseProcessor unless 'wait' is True, in which case this blocks 
+		until it has been committed.  getLatestByZone() and getVersion() are 
+		only updated once the write has been committed so that they always 
+		match what is in the database.
+		"""
+		
+		# Validate the entries
+		for timestamp,zone,status,wxAdjustment in rows:
+			if status not in ('on', 'off'):
+				raise ValueError("Invalid status code '%s'" % status)
+		if not rows:
+			return True
 			
-		# Add the entry to the database
-		if status == 'on':
-			rid = self._backend.appendRequest('INSERT INTO pi2o (dateTimeStart,dateTimeStop,zone,wxAdjust) VALUES (%i,%i,%i,%f)' % (timestamp, 0, zone, wxAdjustment))
+		# Build the SQL commands.  dateTimeStart is the primary key so start
+		# times that have already been used are moved forward a second.
+		cmds = []
+		entries = []
+		with self._startLock:
+			for timestamp,zone,status,wxAdjustment in rows:
+				timestamp = int(timestamp)
+				if status == 'on':
+					while timestamp in self._recentStarts:
+						timestamp += 1
+					self._recentStarts.append( timestamp )
+				if wxAdjustment is None:
+					wxAdjustment = 1.0
+				entries.append( (timestamp, zone, status, wxAdjustment) )
+				
+				if status == 'on':
+					cmds.append( (_INSERT_SQL, (timestamp, 0, zone, wxAdjustment)) )
+				else:
+					cmds.append( (_CLOSE_SQL, (timestamp, zone)) )
+			
+		# Add the entries to the database and then refresh the latest entry 
+		# for the zones that were written to
+		zones = sorted(set(entry[1] for entry in entries))
+		if wait:
+			rid = self._backend.appendRequest(cmds)
 			output = self._backend.getResponse(rid)
+			self._refreshLatest(zones)
 		else:
-			rid = self._backend.appendRequest('SELECT dateTimeStart FROM pi2o WHERE zone == %i AND dateTimeStop == 0 ORDER BY dateTimeStart DESC' % zone)
-			output = self._backend.getResponse(rid)
-			row = output[0]
-			rid = self._backend.appendRequest('UPDATE pi2o SET dateTimeStop = %i WHERE dateTimeStart == %i AND zone == %i' % (timestamp, row['dateTimeStart'], zone))
-			output = self._backend.getResponse(rid)
+			self._backend.appendWrite(cmds, callback=lambda: self._refreshLatest(zones))
 			
 		return True
+		
+	def _refreshLatest(self, zones):
+		"""
+		Re-read the most recent entry for each of the given zones from the 
+		database, bump the version, and drop any cached getData() results.  
+		This is called after the writes for those zones have been committed,
+		or have failed, so that getLatestByZone() and getData() never show 
+		entries that are not in the database or miss ones that are.
+		"""
+		
+		conn = self._conn()
+		for zone in zones:
+			output = conn.execute(_LATEST_SQL, (zone,)).fetchall()
+			if len(output) > 0:
+				self._latestByZone[zone] = output[0]
+			else:
+				self._latestByZone.pop(zone, None)
+		self._version += 1
+		self._dataCache.clear()
@@ -43,6 +43,8 @@ def _make_key(args, kwds, typed,
 def expiring_cache(maxage=3600, maxsize=100, typed=False):
     """Expiring cache decorator.
 
+    Cached results are discarded once they are more than *maxage* seconds old.
+
     If *maxsize* is set to None, the LRU features are disabled and the cache
     can grow without bound.
 
@@ -75,9 +77,9 @@ def expiring_cache(maxage=3600, maxsize=100, typed=False):
         _len = len                      # localize the global len() function
         lock = RLock()                  # because linkedlist updates aren't threadsafe
         root = []                       # root of the circular doubly linked list
-        root[:] = [root, root, None, None]      # initialize by pointing to self
-        nonlocal_root = [root]                  # make updateable non-locally
-        PREV, NEXT, KEY, RESULT = 0, 1, 2, 3    # names for the link fields
+        root[:] = [root, root, None, None, None]    # initialize by pointing to self
+        nonlocal_root = [root]                      # make updateable non-locally
+        PREV, NEXT, KEY, RESULT, TIME = 0, 1, 2, 3, 4   # names for the link fields
 
         if maxsize == 0:
 
@@ -94,13 +96,13 @@ def expiring_cache(maxage=3600, maxsize=100, typed=False):
                 # simple caching without ordering or size limit
                 key = make_key(args, kwds, typed)
                 tNow = time.time()
-                result = cache_get(key, root)   # root used here as a unique not-found sentinel
-                if result is not root and tNow-stats[UPDATED] < maxage:
+                entry = cache_get(key)
+                if entry is not None and tNow-entry[1] < maxage:
                     stats[HITS] += 1
-                    return result
+                    return entry[0]
                 result = user_function(*args, **kwds)
-                cache[key] = result
                 stats[UPDATED] = time.time()
+                cache[key] = (result, stats[UPDATED])
                 stats[MISSES] += 1
                 return result
 
@@ -113,12 +115,13 @@ def expiring_cache(maxage=3600, maxsize=100, typed=False):
                     tNow = time.time()
                     link = cache_get(key)
                     if link is not None:
-                        if tNow - stats[UPDATED] < maxage:
-                            # record recent use of the key by moving it to the front of the list
-                            root, = nonlocal_root
-                            link_prev, link_next, key, result = link
-                            link_prev[NEXT] = link_next
-                            link_next[PREV] = link_prev
+                        # take the link out of the list
+                        root, = nonlocal_root
+                        link_prev, link_next, key, result, updated = link
+                        link_prev[NEXT] = link_next
+                        link_next[PREV] = link_prev
+                        if tNow - updated < maxage:
+                            # record recent use of the key by putting it back at the front of the list
                             last = root[PREV]
                             last[NEXT] = root[PREV] = link
                             link[PREV] = last
@@ -126,15 +129,12 @@ def expiring_cache(maxage=3600, maxsize=100, typed=False):
                             stats[HITS] += 1
                             return result
                         else:
-                            # empty the oldest link and make it the new root
-                            root, = nonlocal_root
-                            link_prev, link_next, key, result = link
-                            root[KEY] = root[RESULT] = None
-                            # now update the cache dictionary for the new links
+                            # the result is too old, drop the link from the cache dictionary too
                             del cache[key]
                 result = user_function(*args, **kwds)
                 with lock:
                     root, = nonlocal_root
+                    stats[UPDATED] = time.time()
                     if key in cache:
                         # getting here means that this same key was added to the
                         # cache while the lock was released.  since the link
@@ -146,20 +146,20 @@ def expiring_cache(maxage=3600, maxsize=100, typed=False):
                         oldroot = root
                         oldroot[KEY] = key
                         oldroot[RESULT] = result
+                        oldroot[TIME] = stats[UPDATED]
                         # empty the oldest link and make it the new root
                         root = nonlocal_root[0] = oldroot[NEXT]
                         oldkey = root[KEY]
                         oldvalue = root[RESULT]
-                        root[KEY] = root[RESULT] = None
+                        root[KEY] = root[RESULT] = root[TIME] = None
                         # now update the cache dictionary for the new links
                         del cache[oldkey]
                         cache[key] = oldroot
                     else:
                         # put result in a new link at the front of the list
                         last = root[PREV]
-                        link = [last, root, key, result]
+                        link = [last, root, key, result, stats[UPDATED]]
                         last[NEXT] = root[PREV] = cache[key] = link
-                    stats[UPDATED] = time.time()
                     stats[MISSES] += 1
                 return result
 
@@ -173,7 +173,7 @@ def expiring_cache(maxage=3600, maxsize=100, typed=False):
             with lock:
                 cache.clear()
                 root = nonlocal_root[0]
-                root[:] = [root, root, None, None]
+                root[:] = [root, root, None, None, None]
                 stats[:] = [0.0, 0, 0]
 
         wrapper.__wrapped__ = user_function
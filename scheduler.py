@@ -40,6 +40,11 @@ class ScheduleProcessor(threading.Thread):
         self.thread = None
         self.alive = threading.Event()
         
+        # Background weather lookups ahead of a scheduling block
+        self._wxThread = None
+        self._wxPrefetched = None
+        self._wxResult = None
+        
     def start(self):
         if self.thread is not None:
             self.cancel()
@@ -58,6 +63,38 @@ class ScheduleProcessor(threading.Thread):
             
         schLogger.info('Stopped the ScheduleProcessor background thread')
         
+    def _prefetchWeather(self, key, pws, adj_max):
+        """
+        Look up the current temperature and weather adjustment in a helper 
+        thread and publish them as a (key, temperature, adjustment) tuple in
+        self._wxResult.  Either value is None if its lookup failed.  The 
+        scheduler only ever reads the published values so that a slow or 
+        failed lookup never holds up a scheduler tick.
+        """
+        
+        if self._wxThread is not None and self._wxThread.isAlive():
+            return False
+            
+        def fetch():
+            try:
+                temp = getCurrentTemperature(pws)
+            except Exception as e:
+                schLogger.warning('Cannot get the current temperature for %s: %s', pws, str(e))
+                temp = None
+            try:
+                adjust = getWeatherAdjustment(pws, adj_max=adj_max)
+            except Exception as e:
+                schLogger.warning('Cannot compute the weather adjustment for %s: %s', pws, str(e))
+                adjust = None
+            self._wxResult = (key, temp, adjust)
+            schLogger.debug('Fetched the weather information for %s', pws)
+            
+        self._wxThread = threading.Thread(target=fetch, name='wxPrefetch')
+        self._wxThread.setDaemon(1)
+        self._wxThread.start()
+        
+        return True
+        
     def run(self):
         self.running = True
         self.wxAdjust = None
@@ -72,16 +109,18 @@ class ScheduleProcessor(threading.Thread):
                 return True
                 
             try:
-                tNow = datetime.now()
-                tNow = tNow.replace(microsecond=0)
-                tNowDB = int(tNow.strftime("%s"))
+                tNowDB = int(time.time())
+                tNow = datetime.fromtimestamp(tNowDB)
                 schLogger.debug('Starting scheduler polling at %s LT', tNow)
                 
+                # Read in the current month's schedule
+                schedule = dict(self.config.items('Schedule%i' % tNow.month))
+                
                 # Is the current schedule active?
-                if self.config.get('Schedule%i' % tNow.month, 'enabled') == 'on':
+                if schedule['enabled'] == 'on':
                     ## If so, query the run interval and start time for this block
-                    interval = int(self.config.get('Schedule%i' % tNow.month, 'interval'))
-                    h,m = [int(i) for i in self.config.get('Schedule%i' % tNow.month, 'start').split(':', 1)]
+                    interval = int(schedule['interval'])
+                    h,m = [int(i) for i in schedule['start'].split(':', 1)]
                     s = 0
                     schLogger.debug('Current month of %s is enabled with a start time of %i:%02i:%02i LT', tNow.strftime("%B"), h, m, s)
                     
@@ -92,20 +131,47 @@ class ScheduleProcessor(threading.Thread):
                     ##        resume things that have been delayed due to weather.
                     tSchedule = tNow.replace(hour=int(h), minute=int(m), second=int(s))
                     tSchedule += self.tDelay
-                    if (tNow >= tSchedule and tNow-tSchedule < timedelta(seconds=60)) or self.blockActive:
+                    tScheduleDB = int(time.mktime(tSchedule.timetuple()))
+                    
+                    ## If the block is about to start, warm up the weather cache
+                    if not self.blockActive and self._wxPrefetched != tScheduleDB \
+                       and 0 < tScheduleDB-tNowDB <= 600:
+                        pws = self.config.get('Weather', 'pws')
+                        if pws != '' and self.config.get('Weather', 'enabled') == 'on':
+                            if self._prefetchWeather(tScheduleDB, pws, self.config.getint('Weather', 'max_adjust')):
+                                self._wxPrefetched = tScheduleDB
+                                
+                    if 0 <= tNowDB-tScheduleDB < 60 or self.blockActive:
                         schLogger.debug('Scheduling block appears to be starting or active')
                         
                         ### Load in the WUnderground API information
                         pws = self.config.get('Weather', 'pws')
                         adj_max = self.config.getint('Weather', 'max_adjust')
                         enb = self.config.get('Weather', 'enabled')
+                        useWeather = (pws != '' and enb == 'on')
                         
+                        ### Pick up the weather information published by the
+                        ### helper thread.  If it is not there yet, start a 
+                        ### lookup and give it until 30 s into the block 
+                        ### before carrying on without it.
+                        temp, adjust = None, None
+                        if useWeather:
+                            wx = self._wxResult
+                            if wx is not None and wx[0] == tScheduleDB:
+                                temp, adjust = wx[1], wx[2]
+                            else:
+                                if self._wxPrefetched != tScheduleDB:
+                                    if self._prefetchWeather(tScheduleDB, pws, adj_max):
+                                        self._wxPrefetched = tScheduleDB
+                                if not self.blockActive and tNowDB-tScheduleDB < 30:
+                                    schLogger.debug('Waiting on the weather information')
+                                    continue
+                                    
                         ### Check the temperature to see if it is safe to run
-                        if pws != '' and enb == 'on':
-                            try:
-                                temp = getCurrentTemperature(pws)
-                            except RuntimeError:
-                                schLogger.warning('Cannot connect to WUnderground for temperature information, skipping check')
+                        if useWeather:
+                            if temp is None:
+                                if not self.blockActive:
+                                    schLogger.warning('No temperature information available, skipping check')
                             else:
                                 if temp > 35.0:
                                     #### Everything is good to go, reset the delay
@@ -128,22 +194,20 @@ class ScheduleProcessor(threading.Thread):
                                 
                         ### Load in the current weather adjustment, if needed
                         if self.wxAdjust is None:
-                            if pws != '' and enb == 'on':
-                                try:
-                                    self.wxAdjust = getWeatherAdjustment(pws, adj_max=adj_max)
-                                except RuntimeError:
-                                    schLogger.warning('Cannot connect to WUnderground for weather adjustment, setting to 100%')
-                                    self.wxAdjust = 1.0
-                                except Exception as e:
-                                    schLogger.warning('Error computing weather adjustment, setting to 100%')
+                            if useWeather:
+                                if adjust is None:
+                                    schLogger.warning('No weather adjustment available, setting to 100%')
                                     self.wxAdjust = 1.0
+                                else:
+                                    self.wxAdjust = adjust
                             else:
                                 self.wxAdjust = 1.0
                             schLogger.info('Set weather adjustment to %.1f%%', self.wxAdjust*100.0)
                         
-                        ### Convert the interval into a timedeltas
-                        interval = timedelta(days=interval)
-                        schLogger.debug('Run interval for this schedule set to %s', interval)
+                        ### Convert the interval into seconds, leaving a three hour 
+                        ### margin so that a slightly late start still runs
+                        schLogger.debug('Run interval for this schedule set to %i days', interval)
+                        interval = interval*86400 - 3*3600
                         
                         ### Load in the last schedule run times
                         previousRuns = self.history.getData(scheduledOnly=True)
@@ -153,8 +217,8 @@ class ScheduleProcessor(threading.Thread):
                             #### Is the current zone even active?
                             if self.config.get('Zone%i' % zone, 'enabled') == 'on':
                                 #### What duration do we use for this zone?
-                                duration = int(self.config.get('Schedule%i' % tNow.month, 'duration%i' % zone))
-                                if self.config.get('Schedule%i' % tNow.month, 'wxadjust') == 'on':
+                                duration = int(schedule['duration%i' % zone])
+                                if schedule['wxadjust'] == 'on':
                                     duration = duration*self.wxAdjust
                                     adjustmentUsed = self.wxAdjust*1.0
                                 else:
@@ -162,22 +226,22 @@ class ScheduleProcessor(threading.Thread):
                                     adjustmentUsed = -2.0
                                     schLogger.info('Weather adjustment is not enabled for this schedule, ignoring previous value')
                                     
-                                duration = timedelta(minutes=int(duration), seconds=int((duration*60) % 60))
+                                duration = int(duration)*60 + int((duration*60) % 60)
                                 
                                 #### What is the last run time for this zone?
-                                tLast = datetime.fromtimestamp( self.hardwareZones[zone-1].getLastRun() )
+                                tLast = int(self.hardwareZones[zone-1].getLastRun())
                                 for entry in previousRuns:
-                                    if entry['zone'] == zone:
-                                        tLast = datetime.fromtimestamp( entry['dateTimeStart'] )
+                                    if entry.zone == zone:
+                                        tLast = int(entry.dateTimeStart)
                                         break
                                         
                                 if self.hardwareZones[zone-1].isActive():
                                     #### If the zone is active, check how long it has been on
-                                    if tNow-tLast >= duration:
+                                    if tNowDB-tLast >= duration:
                                         self.hardwareZones[zone-1].off()
                                         self.history.writeData(tNowDB, zone, 'off')
                                         schLogger.info('Zone %i - off', zone)
-                                        schLogger.info('  Run Time: %s', (tNow-tLast))
+                                        schLogger.info('  Run Time: %s', timedelta(seconds=tNowDB-tLast))
                                     else:
                                         self.blockActive = True
                                         break
@@ -189,12 +253,12 @@ class ScheduleProcessor(threading.Thread):
                                         if zone in self.processedInBlock:
                                             continue
                                             
-                                    if tNow - tLast >= interval - timedelta(hours=3):
+                                    if tNowDB-tLast >= interval:
                                         self.hardwareZones[zone-1].on()
                                         self.history.writeData(tNowDB, zone, 'on', wxAdjustment=adjustmentUsed)
                                         schLogger.info('Zone %i - on', zone)
-                                        schLogger.info('  Last Ran: %s LT (%s ago)', tLast, tNow-tLast)
-                                        schLogger.info('  Duration: %s', duration)
+                                        schLogger.info('  Last Ran: %s LT (%s ago)', datetime.fromtimestamp(tLast), timedelta(seconds=tNowDB-tLast))
+                                        schLogger.info('  Duration: %s', timedelta(seconds=duration))
                                         self.blockActive = True
                                         self.processedInBlock.append( zone )
                                         break
@@ -6,8 +6,11 @@ Module for reading in weather conditions from Weather Underground.
 
 import json
 import time
+import errno
+import socket
+import httplib
 import logging
-import urllib2
+import threading
 from datetime import datetime, timedelta
 
 from expiring_cache import expiring_cache
@@ -86,24 +89,75 @@ class _rateLimiter(object):
 _rl = _rateLimiter()
 
 
+# Persistent connection to the weather API
+_WX_HOST = 'api.weather.com'
+_wxConn = None
+_wxConnLock = threading.Lock()
+
+
+def _getJSON(path, timeout=30):
+    """
+    Issue a GET request for the given path on the weather API and return the 
+    decoded JSON response.  The HTTPS connection is kept open between calls 
+    and is re-opened once if the server has closed it in the meantime.
+    """
+    
+    global _wxConn
+    
+    with _wxConnLock:
+        for attempt in (1, 2):
+            if _wxConn is None:
+                _wxConn = httplib.HTTPSConnection(_WX_HOST, timeout=timeout)
+            elif _wxConn.sock is not None:
+                _wxConn.sock.settimeout(timeout)
+            reused = _wxConn.sock is not None
+            
+            try:
+                _wxConn.request('GET', path)
+                resp = _wxConn.getresponse()
+                body = resp.read()
+            except (httplib.HTTPException, socket.error) as e:
+                _wxConn.close()
+                _wxConn = None
+                
+                ## Only a kept-alive connection that the server has since
+                ## dropped is worth retrying.  Timeouts and everything else
+                ## are passed on.
+                if isinstance(e, socket.timeout):
+                    stale = False
+                elif isinstance(e, socket.error):
+                    stale = e.errno in (errno.ECONNRESET, errno.EPIPE)
+                else:
+                    stale = isinstance(e, httplib.BadStatusLine)
+                if attempt == 2 or not reused or not stale:
+                    raise
+            else:
+                if resp.will_close:
+                    _wxConn.close()
+                    _wxConn = None
+                break
+                
+    if resp.status != 200:
+        raise IOError("HTTP Error %i: %s" % (resp.status, resp.reason))
+        
+    return json.loads(body)
+
+
 def getCurrentConditions(pws, timeout=30):
     """
     Get the current conditions of the personal weather station using WUnderground.
     """
     
     # Get the URL
-    url = "https://api.weather.com/v2/pws/observations/current?apiKey=6532d6454b8aa370768e63d6ba5a832e&stationId=%s&format=json&units=e" % pws
+    url = "/v2/pws/observations/current?apiKey=6532d6454b8aa370768e63d6ba5a832e&stationId=%s&format=json&units=e" % pws
     
     # Check the rate limiter
     _rl.clearToSend()
     
     try:
-        uh = urllib2.urlopen(url, None, timeout)
+        data = _getJSON(url, timeout=timeout)
     except Exception as e:
         raise RuntimeError("Failed to connect to WUnderground for current conditions: %s" % str(e))
-    else:
-        data = json.loads(uh.read())
-        uh.close()
         
     return data
 
@@ -115,18 +169,15 @@ def getThreeDayHistory(pws, timeout=30):
     """
     
     # Get the URL
-    url = "https://api.weather.com/v2/pws/observations/all/3day?apiKey=6532d6454b8aa370768e63d6ba5a832e&stationId=%s&format=json&units=e" % pws
+    url = "/v2/pws/observations/all/3day?apiKey=6532d6454b8aa370768e63d6ba5a832e&stationId=%s&format=json&units=e" % pws
     
     # Check the rate limiter
     _rl.clearToSend()
     
     try:
-        uh = urllib2.urlopen(url, None, timeout)
+        data = _getJSON(url, timeout=timeout)
     except Exception as e:
         raise RuntimeError("Failed to connect to WUnderground for three-day history: %s" % str(e))
-    else:
-        data = json.loads(uh.read())
-        uh.close()
         
     return data
 